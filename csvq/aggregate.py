@@ -23,11 +23,37 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 # ----------------------------------------------------------------------------
 
+import math
+
 from csvq.relation import Attribute, Relation
+from csvq.structure import VCat
 
 # ----------------------------------------------------------------------------
 
 class Aggregate(Relation):
+	""" Accumulates columns of the input relation into a single tuple.
+	
+	An aggregation operation is a class that implements:
+		- `__init__( self )`: Initialize an empty accumulator
+		- `__call__( self, x )`: Accumulate one value
+		- `value_type( input_type )`: [static] The type of the result
+		- `value( self )`: The accumulated result
+	An aggregation operation may also support batched accumulation by
+	implementing:
+		- `from_values( xs )`: [classmethod] An accumulator for a list of values
+		- `combine( self, other )`: Merge `other` into `self` and return `self`
+	The input is consumed in chunks of `chunk_size` tuples. Operations that
+	support batching accumulate each chunk with builtin (C-level) reductions;
+	the others are called once per value.
+	
+	If all operations support batching, the accumulators of several Aggregates
+	over relations with the same attributes can be merged: see `states()` and
+	`from_states()`. An Aggregate over a `VCat` does this for each of the
+	concatenated relations.
+	"""
+	
+	chunk_size = 65536
+	
 	def __init__( self, in_relation, aggregators ):
 		def attr( n, f ):
 			input_type = in_relation.attribute( n ).type()
@@ -36,14 +62,91 @@ class Aggregate(Relation):
 			return Attribute( name, type )
 		attributes = tuple( attr( n, t ) for (n, t) in aggregators )
 		super().__init__( attributes = attributes )
-		self._itr = iter(in_relation)
+		self._in_relation = in_relation
+		self._aggregators = tuple( aggregators )
 		self._fs = tuple( (in_relation.index(n), t()) for (n, t) in aggregators )
+		self._states = None
+		
+	@classmethod
+	def from_states( cls, attributes, states ):
+		""" Returns an Aggregate whose result is given by the accumulators
+		`states`, one for each attribute in `attributes`.
+		"""
+		a = cls.__new__( cls )
+		Relation.__init__( a, attributes = attributes )
+		a._states = tuple( states )
+		return a
+		
+	def states( self ):
+		""" Consumes the input and returns the accumulators, one for each
+		output column.
+		"""
+		if self._states is None:
+			self._states = self._accumulate()
+		return self._states
+		
+	@staticmethod
+	def _batched( f ):
+		return hasattr( f, "from_values" ) and hasattr( f, "combine" )
+		
+	def _chunks( self ):
+		""" Yields a dict `{index: [value]}` of the aggregated columns for each
+		chunk of at most `chunk_size` tuples of the input.
+		
+		The columns are taken from the input's `batches()`, so no tuples are
+		assembled for inputs that store or parse their data by column.
+		"""
+		idx = sorted( {i for (i, f) in self._fs} )
+		if not idx:
+			return
+		for columns in self._in_relation.batches( idx ):
+			n = len(columns[0])
+			if n <= self.chunk_size:
+				yield dict( zip( idx, columns ) )
+			else:
+				for s in range(0, n, self.chunk_size):
+					yield {i: c[s:s + self.chunk_size] for (i, c) in zip( idx, columns )}
+		
+	def _accumulate( self ):
+		# VCat concatenates its inputs by position, so the inputs can only be
+		# aggregated separately if their attributes are in the same order
+		if (isinstance( self._in_relation, VCat )
+			and all( r.attributes() == self._in_relation.attributes()
+					 for r in self._in_relation._relations )
+			and all( Aggregate._batched( f ) for (i, f) in self._fs )):
+			parts = [Aggregate( r, self._aggregators ).states()
+					 for r in self._in_relation._relations]
+			return tuple( tree_reduce( list( states ) ) for states in zip( *parts ) )
+		
+		partials = tuple( [] for _ in self._fs )
+		for columns in self._chunks():
+			for ((i, f), states) in zip( self._fs, partials ):
+				if Aggregate._batched( f ):
+					states.append( type(f).from_values( columns[i] ) )
+				else:
+					for x in columns[i]:
+						f( x )
+		for ((i, f), states) in zip( self._fs, partials ):
+			if states:
+				f.combine( tree_reduce( states ) )
+		return tuple( f for (i, f) in self._fs )
 		
 	def __iter__( self ):
-		for t in self._itr:
-			for (i, f) in self._fs:
-				f( t[i] )
-		yield tuple( f.value() for (i, f) in self._fs )
+		yield tuple( f.value() for f in self.states() )
+		
+# ----------------------------------------------------------------------------
+
+def tree_reduce( states ):
+	""" Combines a non-empty list of accumulators pairwise in a balanced binary
+	tree, which bounds the rounding error of the floating-point accumulators
+	by O(log n) rather than O(n) in the number of states.
+	"""
+	while len(states) > 1:
+		paired = [a.combine( b ) for (a, b) in zip( states[0::2], states[1::2] )]
+		if len(states) % 2 == 1:
+			paired.append( states[-1] )
+		states = paired
+	return states[0]
 		
 # ----------------------------------------------------------------------------
 # ----------------------------------------------------------------------------
@@ -55,6 +158,16 @@ class Count:
 	def __call__( self, x ):
 		self._n += 1
 		
+	@classmethod
+	def from_values( cls, xs ):
+		c = cls()
+		c._n = len(xs)
+		return c
+		
+	def combine( self, other ):
+		self._n += other._n
+		return self
+		
 	@staticmethod
 	def value_type( input_type ):
 		return int
@@ -65,57 +178,139 @@ class Count:
 # ----------------------------------------------------------------------------
 		
 class Max:
+	""" Maximum.
+	
+	As in a fold with `>`, an unordered first value such as NaN is the result,
+	and unordered values after an ordered one are ignored. The accumulator
+	keeps the first value if it is unordered, and the maximum of the values
+	after the leading unordered ones, so that chunks combine in order to the
+	same result.
+	"""
+	
 	def __init__( self ):
 		self._max = None
+		self._unordered = None
 		
 	def __call__( self, x ):
-		if self._max is None:
+		if self._max is not None:
+			if x > self._max:
+				self._max = x
+		elif x == x:
 			self._max = x
-		else:
-			self._max = max( self._max, x )
+		elif self._unordered is None:
+			self._unordered = x
+			
+	@classmethod
+	def from_values( cls, xs ):
+		m = cls()
+		k = 0
+		while k < len(xs) and xs[k] != xs[k]:
+			k += 1
+		if k > 0:
+			m._unordered = xs[0]
+			xs = xs[k:]
+		if xs:
+			m._max = max( xs )
+		return m
+		
+	def combine( self, other ):
+		if self._max is None:
+			if self._unordered is None:
+				self._unordered = other._unordered
+			self._max = other._max
+		elif other._max is not None and other._max > self._max:
+			self._max = other._max
+		return self
 		
 	@staticmethod
 	def value_type( input_type ):
 		return input_type
 		
 	def value( self ):
+		if self._unordered is not None:
+			return self._unordered
 		return self._max
 		
 # ----------------------------------------------------------------------------
 		
 class Mean:
 	def __init__( self ):
-		self._m = 0.0
+		self._sum = 0.0
 		self._n = 0
 		
 	def __call__( self, x ):
 		self._n += 1
-		self._m += (x - self._m) / self._n
+		self._sum += x
+		
+	@classmethod
+	def from_values( cls, xs ):
+		m = cls()
+		m._n = len(xs)
+		m._sum = sum( xs )
+		return m
+		
+	def combine( self, other ):
+		self._n += other._n
+		self._sum += other._sum
+		return self
 		
 	@staticmethod
 	def value_type( input_type ):
 		return input_type
 		
 	def value( self ):
-		return self._m
+		if self._n == 0:
+			return 0.0
+		return self._sum / self._n
 		
 # ----------------------------------------------------------------------------
 		
 class Min:
+	""" Minimum. Unordered values are treated as in `Max`.
+	"""
+	
 	def __init__( self ):
 		self._min = None
+		self._unordered = None
 		
 	def __call__( self, x ):
-		if self._min is None:
+		if self._min is not None:
+			if x < self._min:
+				self._min = x
+		elif x == x:
 			self._min = x
-		else:
-			self._min = min( self._min, x )
+		elif self._unordered is None:
+			self._unordered = x
+		
+	@classmethod
+	def from_values( cls, xs ):
+		m = cls()
+		k = 0
+		while k < len(xs) and xs[k] != xs[k]:
+			k += 1
+		if k > 0:
+			m._unordered = xs[0]
+			xs = xs[k:]
+		if xs:
+			m._min = min( xs )
+		return m
+		
+	def combine( self, other ):
+		if self._min is None:
+			if self._unordered is None:
+				self._unordered = other._unordered
+			self._min = other._min
+		elif other._min is not None and other._min < self._min:
+			self._min = other._min
+		return self
 		
 	@staticmethod
 	def value_type( input_type ):
 		return input_type
 		
 	def value( self ):
+		if self._unordered is not None:
+			return self._unordered
 		return self._min
 
 # ----------------------------------------------------------------------------
@@ -126,6 +321,25 @@ class Sum:
 		
 	def __call__( self, x ):
 		self._sum += x
+		
+	@classmethod
+	def from_values( cls, xs ):
+		s = cls()
+		if xs and isinstance( xs[0], float ):
+			# Correctly rounded; the naive sum loses precision on long chunks
+			try:
+				s._sum = math.fsum( xs )
+			except (ValueError, OverflowError):
+				# fsum() raises on inf - inf and on overflow, where sum() gives
+				# nan and inf
+				s._sum = sum( xs )
+		else:
+			s._sum = sum( xs )
+		return s
+		
+	def combine( self, other ):
+		self._sum += other._sum
+		return self
 	
 	@staticmethod
 	def value_type( input_type ):
@@ -137,17 +351,62 @@ class Sum:
 # ----------------------------------------------------------------------------
 		
 class Variance:
+	""" Sample variance.
+	
+	Values are accumulated as the sums `S1` and `S2` of `x - C` and `(x - C)^2`,
+	where the shift `C` is the first value seen. Shifting the origin keeps the
+	sums well-conditioned without the per-value division of Welford's update.
+	"""
+	
 	def __init__( self ):
-		self._mean = 0.0
 		self._n = 0
-		self._m2 = 0.0
+		self._shift = 0.0
+		self._s1 = 0.0
+		self._s2 = 0.0
 		
 	def __call__( self, x ):
+		if self._n == 0:
+			self._shift = x
 		self._n += 1
-		d = x - self._mean
-		self._mean += d / self._n
-		d2 = x - self._mean
-		self._m2 += d*d2
+		d = x - self._shift
+		self._s1 += d
+		self._s2 += d*d
+		
+	def _moments( self ):
+		""" Returns `(n, mean, M2)`, where `M2` is the sum of squared
+		deviations from the mean.
+		"""
+		if self._n == 0:
+			return (0, 0.0, 0.0)
+		d = self._s1 / self._n
+		return (self._n, self._shift + d, self._s2 - self._s1 * d)
+		
+	def _set_moments( self, n, mean, m2 ):
+		# Shift to the mean, so that S1 == 0 and S2 == M2
+		self._n = n
+		self._shift = mean
+		self._s1 = 0.0
+		self._s2 = m2
+		
+	@classmethod
+	def from_values( cls, xs ):
+		v = cls()
+		if len(xs) > 0:
+			mean = sum( xs ) / len(xs)
+			v._set_moments( len(xs), mean, sum( (x - mean) * (x - mean) for x in xs ) )
+		return v
+		
+	def combine( self, other ):
+		""" Merges the accumulated moments of `other` into `self` using the
+		pairwise update of Chan, Golub, and LeVeque.
+		"""
+		(na, ma, m2a) = self._moments()
+		(nb, mb, m2b) = other._moments()
+		n = na + nb
+		if n > 0:
+			d = mb - ma
+			self._set_moments( n, ma + d * nb / n, m2a + m2b + d * d * na * nb / n )
+		return self
 		
 	@staticmethod
 	def value_type( input_type ):
@@ -159,4 +418,4 @@ class Variance:
 		elif self._n == 1:
 			return 0.0
 		else:
-			return self._m2 / (self._n - 1)
+			return (self._s2 - self._s1 * self._s1 / self._n) / (self._n - 1)
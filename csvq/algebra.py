@@ -26,43 +26,64 @@
 """ The primitive operations of the relational algebra.
 """
 
-from csvq.relation import Attribute, Relation, Row
+import operator
+
+from csvq.relation import Attribute, PipelineRelation, Relation, tuple_getter
+from csvq.rewrite import tuple_function
 
 # ----------------------------------------------------------------------------
 
-class Projection(Relation):
+class Projection(PipelineRelation):
 	def __init__( self, in_relation, names ):
 		super().__init__( attributes = [in_relation.attribute( name ) for name in names] )
-		self._itr = iter(in_relation)
+		self._in_relation = in_relation
 		self._keep = tuple( in_relation.index(a.name()) for a in self._attributes )
+		self._itr = map( tuple_getter( self._keep ), iter(in_relation) )
 		
-	def __next__( self ):
-		t = next(self._itr)
-		return tuple( t[i] for i in self._keep )
-		
-	def __iter__( self ):
-		return self
+	def batches( self, idx=None ):
+		if not self._keep:
+			return iter(())
+		if idx is None:
+			idx = range(len(self._keep))
+		return self._in_relation.batches( [self._keep[i] for i in idx] )
 
 # ----------------------------------------------------------------------------
 
-class Selection(Relation):
-	def __init__( self, in_relation, predicate ):
+def compile_predicate( relation, names, f ):
+	""" Returns a function of a raw tuple of `relation` that applies `f` to the
+	values of the columns in `names`.
+	
+	Parameters:
+	
+	- `names`: `str` or `[str]` A single column name, or a sequence of names
+	- `f`: A function taking one positional argument per name
+	"""
+	if isinstance( names, str ):
+		i = relation.index( names )
+		return lambda t: f( t[i] )
+	else:
+		pick = tuple_getter( relation.index( n ) for n in names )
+		return lambda t: f( *pick( t ) )
+
+class Selection(PipelineRelation):
+	""" Retains those tuples that satisfy a predicate.
+	
+	If `names` is None, `predicate` is applied to a `Row` (or, if it can be
+	rewritten by `csvq.rewrite`, to the tuple itself). Otherwise it is applied
+	directly to the values of the named columns (see `compile_predicate()`).
+	"""
+	
+	def __init__( self, in_relation, predicate, names=None ):
 		super().__init__( attributes = in_relation._attributes, index = in_relation._index )
-		self._itr = iter(in_relation)
-		self._predicate = predicate
-		
-	def __next__( self ):
-		while True:
-			t = next(self._itr)
-			if self._predicate( Row( self, t ) ):
-				return t
-				
-	def __iter__( self ):
-		return self
+		if names is None:
+			test = tuple_function( in_relation, predicate )
+		else:
+			test = compile_predicate( in_relation, names, predicate )
+		self._itr = filter( test, iter(in_relation) )
 		
 # ----------------------------------------------------------------------------
 
-class Rename(Relation):
+class Rename(PipelineRelation):
 	def __init__( self, in_relation, substitutions ):
 		renamed = []
 		for a in in_relation._attributes:
@@ -71,16 +92,28 @@ class Rename(Relation):
 			except KeyError:
 				renamed.append( a )
 		super().__init__( attributes = renamed )
+		# Renaming does not touch the tuples, so iter() hands out the input
+		# iterator itself
+		self._in_relation = in_relation
 		self._itr = iter(in_relation)
 		
-	def __next__( self ):
-		return next(self._itr)
-				
-	def __iter__( self ):
-		return self
+	def batches( self, idx=None ):
+		return self._in_relation.batches( idx )
 		
 # ----------------------------------------------------------------------------
 
+def key_getter( idx ):
+	""" Returns a function that extracts the hashable join key at positions
+	`idx` from a tuple.
+	
+	A single-column key is the bare value rather than a 1-tuple, so that
+	building and hashing the key is one C-level `itemgetter` call per row.
+	"""
+	if len(idx) == 0:
+		return lambda t: ()
+	else:
+		return operator.itemgetter( *idx )
+
 # TODO: Should implement "join algorithm" separately and provide it as 
 # parameter to "join type" class. So, NaturalJoin would construct a join 
 # predicate and delegate to a generic HashJoin implementation.
@@ -110,40 +143,29 @@ class HashNaturalJoin(Relation):
 			else:
 				attr_intersection.append( r )
 		super().__init__( attributes = attr_union )
+		self._pick_right = tuple_getter( self._idx_right )
 		
 		# Indices of the key set in both relations. Only 'left' is a member
 		# because we're going to compute the hash table for 'right' immediately
-		self._left_key	= [left.index( a.name() ) for a in attr_intersection]
-		right_key		= [right.index( a.name() ) for a in attr_intersection]
+		self._left_key	= key_getter( [left.index( a.name() ) for a in attr_intersection] )
+		right_key		= key_getter( [right.index( a.name() ) for a in attr_intersection] )
 		# Read 'right' into hash table
 		self._right_hash = dict()
 		for t in right:
-			key = tuple( t[i] for i in right_key )
-			try:
-				v = self._right_hash[key]
-			except KeyError:
-				v = []
-				self._right_hash[key] = v
-			v.append( t )
+			self._right_hash.setdefault( right_key( t ), [] ).append( t )
 			
 		# Lazy iteration over 'left'
 		self._itr = iter(left)
 		
 	def _join_row( self, l, r ):
-		j = list(l)
-		for i in self._idx_right:
-			j.append( r[i] )
-		return tuple(j)
+		return l + self._pick_right( r )
 		
 	def __iter__( self ):
-		while True:
-			l = next(self._itr)
-			key = tuple( l[i] for i in self._left_key )
-			try:
-				rs = self._right_hash[key]
+		get = self._right_hash.get
+		for l in self._itr:
+			rs = get( self._left_key( l ) )
+			if rs is not None:
 				for r in rs:
 					yield self._join_row( l, r )
-			except KeyError:
-				pass
 
 # ----------------------------------------------------------------------------
@@ -32,8 +32,9 @@ import csvq.functional
 import csvq.relation
 import csvq.structure
 
-import builtins # For overload resolution
+import concurrent.futures
 import contextlib
+import itertools
 
 # ----------------------------------------------------------------------------
 
@@ -102,8 +103,7 @@ def load( filename, delim=',' ):
 	- `filename`: `str`
 	- `delim`: `str` [Optional] Column delimiter string
 	"""
-	with stream( filename, delim ) as input:
-		return evaluate( input )
+	return csvq.relation.InMemoryRelation.from_file( filename, delim )
 		
 def load_typed( filename, delim=',', type_delim=':' ):
 	""" Load a *typed* relation from a file into memory.
@@ -116,8 +116,48 @@ def load_typed( filename, delim=',', type_delim=':' ):
 	- `delim`: `str` [Optional] Column delimiter string
 	- `type_delim`: `str` [Optional] Type annotation delimiter string
 	"""
-	with stream_typed( filename, delim, type_delim ) as input:
-		return evaluate( input )
+	return csvq.relation.InMemoryRelation.from_file_typed( filename, delim, type_delim )
+	
+def load_binary( filename ):
+	""" Load a relation written by `write_binary()` into memory.
+	
+	The result models `RestartableRelation`. The file is read with `pickle`,
+	so it must come from a trusted source.
+	
+	Parameters:
+	
+	- `filename`: `str`
+	"""
+	return csvq.relation.InMemoryRelation.from_binary( filename )
+	
+def load_many( filenames, delim=',' ):
+	""" Load several *untyped* relations from files into memory. The files
+	are loaded on a thread pool.
+	
+	The files are read concurrently, but parsing holds the GIL, so the
+	threads overlap waiting on the disk rather than the parsing itself.
+	Returns a list of relations in the order of `filenames`.
+	
+	Parameters:
+	
+	- `filenames`: `[str]`
+	- `delim`: `str` [Optional] Column delimiter string
+	"""
+	with concurrent.futures.ThreadPoolExecutor() as pool:
+		return list( pool.map( lambda f: load( f, delim ), filenames ) )
+		
+def load_many_typed( filenames, delim=',', type_delim=':' ):
+	""" Load several *typed* relations from files into memory. The files
+	are loaded on a thread pool. See `load_many()`.
+	
+	Parameters:
+	
+	- `filenames`: `[str]`
+	- `delim`: `str` [Optional] Column delimiter string
+	- `type_delim`: `str` [Optional] Type annotation delimiter string
+	"""
+	with concurrent.futures.ThreadPoolExecutor() as pool:
+		return list( pool.map( lambda f: load_typed( f, delim, type_delim ), filenames ) )
 		
 def write( relation, out, delim=',' ):
 	""" Write a relation to a file stream without type information.
@@ -145,6 +185,24 @@ def write_typed( relation, out, delim=',', type_delim=':' ):
 	print( delim.join( typed ), file=out )
 	write_without_headers( relation, out, delim )
 		
+def write_binary( relation, out ):
+	""" Write a relation to a binary file stream in a columnar format.
+	
+	The columns are stored as Python values, so that `load_binary()` restores
+	them without parsing. The format is specific to csvq and is written with
+	`pickle`; only load files from trusted sources.
+	
+	Parameters:
+	
+	- `relation`: `Relation`
+	- `out`: An open writeable binary file handle
+	"""
+	if not isinstance( relation, csvq.relation.InMemoryRelation ):
+		relation = csvq.relation.InMemoryRelation.copy_of( relation )
+	relation.write_binary( out )
+		
+_write_block_size = 8192
+
 def write_without_headers( relation, out, delim=',' ):
 	""" Write only the tuples of a relation to a file stream.
 	
@@ -154,8 +212,18 @@ def write_without_headers( relation, out, delim=',' ):
 	- `out`: An open writeable file handle
 	- `delim`: `str` [Optional] Column delimiter
 	"""
-	for t in relation:
-		print( delim.join( builtins.map( str, t ) ), file=out )
+	# A format string specialized to the number of columns renders each tuple
+	# with a single C-level call; "{}" formats values the same as str()
+	field_delim = delim.replace( "{", "{{" ).replace( "}", "}}" )
+	line = field_delim.join( ["{}"] * relation.n_attributes() ) + "\n"
+	lines = itertools.starmap( line.format, relation )
+	# Write in blocks, so that unbuffered or line-buffered streams see one
+	# write() call per `_write_block_size` rows
+	while True:
+		block = "".join( itertools.islice( lines, _write_block_size ) )
+		if not block:
+			break
+		out.write( block )
 		
 # ----------------------------------------------------------------------------
 # Utility
@@ -213,10 +281,18 @@ def project_complement( relation, *drop ):
 def select( relation, predicate ):
 	""" Retains only those tuples that satisfy `predicate`.
 	
+	The predicate may also be given as a pair `(names, f)`, where `names` is
+	a column name or a sequence of column names. Then `f` is called with the
+	values of those columns as positional arguments, which is faster than
+	constructing a `Row` for each tuple.
+	
 	Parameters:
 	
-	- `predicate`: `Row -> bool`
+	- `predicate`: `Row -> bool` or `(str, t -> bool)` or `([str], (t...) -> bool)`
 	"""
+	if isinstance( predicate, tuple ):
+		(names, f) = predicate
+		return csvq.algebra.Selection( relation, f, names )
 	return csvq.algebra.Selection( relation, predicate )
 	
 @RelationalOperator
@@ -377,4 +453,4 @@ def vector( relation ):
 def tuples( relation ):
 	""" Returns the entire relation as a Python list of tuples.
 	"""
-	return [t for t in relation]
+	return list( relation )
@@ -23,57 +23,78 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 # ----------------------------------------------------------------------------
 
-from csvq.relation import Attribute, Relation, Row
+from csvq.relation import Attribute, InMemoryRelation, PipelineRelation, Relation
+from csvq.rewrite import column_fold, tuple_function
 
 # ----------------------------------------------------------------------------
 
-class Map(Relation):
+class Map(PipelineRelation):
 	def __init__( self, in_relation, fd ):
 		super().__init__( attributes = tuple(fd) )
 		self._in_relation = in_relation
-		self._itr = iter(in_relation)
-		self._fs = tuple( fd.values() )
+		self._fs = tuple( tuple_function( in_relation, f ) for f in fd.values() )
+		self._itr = map( self._map_row, iter(in_relation) )
 		
-	def __next__( self ):
-		t = next(self._itr)
-		return tuple( f( Row( self._in_relation, t ) ) for f in self._fs )
-		
-	def __iter__( self ):
-		return self
+	def _map_row( self, t ):
+		return tuple( [f( t ) for f in self._fs] )
 		
 # ----------------------------------------------------------------------------
 
-class Update(Relation):
+class Update(PipelineRelation):
 	def __init__( self, in_relation, fd ):
 		# for k in fd:
 			# if in_relation.attribute( k.name() ) != k:
 				# raise TypeError( "Incompatible attribute definitions" )
 		super().__init__( attributes = in_relation._attributes, index = in_relation._index )
-		self._itr = iter(in_relation)
 		self._idx = tuple( self.index( k ) for k in fd )
-		self._fs = tuple( fd.values() )
+		self._fs = tuple( tuple_function( self, f ) for f in fd.values() )
+		if len(self._idx) == 1:
+			self._itr = map( self._update_one, iter(in_relation) )
+		else:
+			self._pairs = tuple( zip( self._idx, self._fs ) )
+			self._itr = map( self._update_many, iter(in_relation) )
+			
+	def _update_one( self, t ):
+		# Tuple slicing and concatenation run in C and skip the list copy
+		(i,) = self._idx
+		return t[:i] + (self._fs[0]( t ),) + t[i+1:]
 		
-	def __next__( self ):
-		t = next(self._itr)
-		tprime = list( t )
-		for (i, f) in enumerate(self._fs):
-			tprime[self._idx[i]] = f( Row( self, t ) )
-		return tuple( tprime )
-		
-	def __iter__( self ):
-		return self
+	def _update_many( self, t ):
+		u = list( t )
+		for (i, f) in self._pairs:
+			u[i] = f( t )
+		return tuple( u )
 		
 # ----------------------------------------------------------------------------
 
 class Fold(Relation):
+	""" Folds each function over the tuples of the input.
+	
+	If the input is an InMemoryRelation, the functions of the simple forms
+	recognized by `csvq.rewrite.column_fold()`, such as
+	`lambda acc, t: acc + t.X * t.Y`, are computed by builtin reductions over
+	the stored columns; the others are folded over the tuples.
+	"""
+	
 	def __init__( self, in_relation, fd ):
 		super().__init__( attributes = tuple(fd) )
 		self._in_relation = in_relation
-		self._fs = tuple( f for (f, v) in fd.values() )
+		self._fs = tuple( tuple_function( in_relation, f, 1 ) for (f, v) in fd.values() )
 		self._v  = list( v for (f, v) in fd.values() )
+		if isinstance( in_relation, InMemoryRelation ):
+			self._column_folds = tuple( column_fold( in_relation, f ) for (f, v) in fd.values() )
+		else:
+			self._column_folds = (None,) * len(self._fs)
 		
 	def __iter__( self ):
-		for t in self._in_relation:
-			for i in range(0, len(self._v)):
-				self._v[i] = self._fs[i]( self._v[i], Row( self._in_relation, t ) )
-		yield tuple( self._v )
+		fs = self._fs
+		v = self._v
+		for (i, g) in enumerate(self._column_folds):
+			if g is not None:
+				v[i] = g( self._in_relation._columns, v[i] )
+		ks = [i for (i, g) in enumerate(self._column_folds) if g is None]
+		if ks:
+			for t in self._in_relation:
+				for i in ks:
+					v[i] = fs[i]( v[i], t )
+		yield tuple( v )
@@ -26,40 +26,90 @@
 """ The Relation base class, and facilities for populating Relations with data.
 """
 
+import itertools
 import operator
+import pickle
+import weakref
 
 # ----------------------------------------------------------------------------
 
+def tuple_getter( idx ):
+	""" Returns a function that picks the elements at the positions in `idx`
+	out of a tuple, as a tuple.
+	
+	For two or more positions this is `operator.itemgetter( *idx )`, which
+	runs in C; the zero and one position cases are wrapped so that the result
+	is always a tuple.
+	"""
+	idx = tuple( idx )
+	if len(idx) == 0:
+		return lambda t: ()
+	elif len(idx) == 1:
+		(i,) = idx
+		return lambda t: (t[i],)
+	else:
+		return operator.itemgetter( *idx )
+		
+def line_blocks( file, block_size ):
+	""" Reads the text file `file` in blocks of `block_size` characters, and
+	yields the complete lines (without line terminators) of each block as a
+	list.
+	"""
+	tail = ""
+	while True:
+		block = file.read( block_size )
+		if not block:
+			break
+		# The last element is an incomplete line, or "" if the block ends with
+		# a line terminator
+		lines = (tail + block).split( '\n' )
+		tail = lines.pop()
+		if lines:
+			yield lines
+	if tail:
+		yield [tail]
+		
+# ----------------------------------------------------------------------------
+
+_PARSE = {"float": float, "int": int, "str": str}
+_UNPARSE = {float: "float", int: "int", str: "str"}
+
 class Attribute:
 	""" Stores the name and type of a "column" in the data.
 	
 	The default type is 'str'.
+	
+	Attributes are immutable and interned: while an Attribute with a given
+	name and type exists, constructing another one returns the same instance,
+	so that the relations of a pipeline share their Attribute objects and
+	comparisons of equal attributes succeed on identity.
 	"""
 	
-	def __init__( self, name, type=str ):
-		self._name = name
-		self._type = type
+	__slots__ = ("_name", "_type", "_hash", "__weakref__")
+	
+	_interned = weakref.WeakValueDictionary()
+	
+	def __new__( cls, name, type=str ):
+		key = (name, type)
+		a = cls._interned.get( key )
+		if a is None:
+			a = super().__new__( cls )
+			a._name = name
+			a._type = type
+			a._hash = hash( key )
+			cls._interned[key] = a
+		return a
+		
+	def __reduce__( self ):
+		# Unpickling constructs the Attribute, and so finds the interned instance
+		return (Attribute, (self._name, self._type))
 		
 	@staticmethod
 	def parse_type( type ):
-		if type == "float":
-			return float
-		elif type == "int":
-			return int
-		elif type == "str":
-			return str
-		else:
-			raise KeyError( type )
+		return _PARSE[type]
 			
 	def type_string( self ):
-		if self._type == float:
-			return "float"
-		elif self._type == int:
-			return "int"
-		elif self._type == str:
-			return "str"
-		else:
-			raise KeyError( self._type )
+		return _UNPARSE[self._type]
 		
 	def name( self ):
 		return self._name
@@ -68,10 +118,10 @@ class Attribute:
 		return self._type
 		
 	def __eq__( self, other ):
-		return self._name == other._name and self._type == other._type
+		return self is other or (self._name == other._name and self._type == other._type)
 		
 	def __hash__( self ):
-		return hash( (self._name, self._type) )
+		return self._hash
 		
 # ----------------------------------------------------------------------------
 
@@ -85,8 +135,19 @@ class Row:
 	Row instances also model Iterable.
 	
 	Row instances are valid only as long as the backing Relation is in scope.
+	The operators that pass Rows to user functions (`select`, `map`, `update`,
+	`fold`) allocate a single Row per operator and point it at each tuple
+	in turn, so a Row must not be retained after the function returns;
+	use `tuple(row)` to keep a copy of the data. For the same reason, a Row
+	must not be shared between threads.
+	
+	`Relation.row()` returns an instance of a sub-class of Row specific to the
+	relation's column names (see `row_type()`), in which `row.ColumnName` is a
+	property that reads the tuple element directly.
 	"""
 	
+	__slots__ = ("_relation", "_row_data")
+	
 	def __init__( self, relation, row_data ):
 		self._relation = relation
 		self._row_data = row_data
@@ -103,6 +164,30 @@ class Row:
 	def __iter__( self ):
 		return iter(self._row_data)
 		
+_row_types = {}
+
+def row_type( names ):
+	""" Returns the sub-class of Row for relations with the column names
+	`names`, in which each name that is not already a Row attribute and does
+	not begin with '_' is a property returning the tuple element at its
+	position. Other names are still found by `Row.__getattr__`. The classes
+	are cached by `names`.
+	"""
+	names = tuple( names )
+	try:
+		return _row_types[names]
+	except KeyError:
+		pass
+	def accessor( i ):
+		return property( lambda self: self._row_data[i] )
+	members = {"__slots__": ()}
+	for (i, name) in enumerate(names):
+		if not name.startswith( "_" ) and not hasattr( Row, name ) and name not in members:
+			members[name] = accessor( i )
+	cls = type( "Row", (Row,), members )
+	_row_types[names] = cls
+	return cls
+		
 # ----------------------------------------------------------------------------
 # ----------------------------------------------------------------------------
 
@@ -143,6 +228,73 @@ class Relation:
 					raise TypeError( "Malformed type specification: '" + token + "'" )
 		return tuple( attributes )
 		
+	@staticmethod
+	def parse_columns( lines, attributes, delim=',' ):
+		""" Parses a list of lines (without line terminators) into a list of
+		columns with the types given by `attributes`, or returns None if some
+		line does not have exactly one field per attribute.
+		
+		All fields are split out of a single joined string, each column is a
+		slice of the result, and each non-`str` column is converted by mapping
+		its type over it, so that the per-field work happens in C.
+		"""
+		types = tuple( a.type() for a in attributes )
+		n = len(types)
+		if not lines:
+			return [[] for t in types]
+		if len(delim) != 1 or set( map( str.count, lines, itertools.repeat( delim ) ) ) != {n - 1}:
+			return None
+		fields = delim.join( lines ).split( delim )
+		return [fields[i::n] if t is str else list( map( t, fields[i::n] ) )
+				for (i, t) in enumerate(types)]
+		
+	@staticmethod
+	def parse_tuples( lines, attributes, delim=',', first_line=1 ):
+		""" Parses a list of lines (without line terminators) into a list of
+		tuples with the types given by `attributes`.
+		
+		The lines are parsed a column at a time by `parse_columns()` if
+		possible, and otherwise one at a time. Raises TypeError, naming the
+		line, if a line does not have exactly one field per attribute;
+		`first_line` is the line number of `lines[0]`.
+		"""
+		columns = Relation.parse_columns( lines, attributes, delim )
+		if columns is not None:
+			return list( zip( *columns ) )
+		parse = Relation.row_parser( attributes, delim )
+		try:
+			return list( map( parse, lines ) )
+		except TypeError:
+			for (i, line) in enumerate(lines):
+				try:
+					parse( line )
+				except TypeError as e:
+					raise TypeError( "Line {}: {}".format( first_line + i, e ) ) from None
+			raise
+		
+	@staticmethod
+	def row_parser( attributes, delim=',' ):
+		""" Returns a function that parses one line (without line terminator)
+		into a tuple with the types given by `attributes`.
+		
+		The function is generated for the schema, so that a line with one field
+		per attribute is converted by a single tuple expression such as
+		`(p[0], int(p[1]), float(p[2]))`. The function raises TypeError for
+		a line with a different number of fields.
+		"""
+		types = tuple( a.type() for a in attributes )
+		fields = ", ".join( "p[{0}]".format( i ) if t is str else "t{0}(p[{0}])".format( i )
+							for (i, t) in enumerate(types) )
+		source = ("def parse( line ):\n"
+				  "\tp = line.split( delim )\n"
+				  "\tif len(p) != n:\n"
+				  "\t\traise TypeError( 'expected " + str( len(types) ) + " fields, found ' + str( len(p) ) )\n"
+				  "\treturn (" + fields + ("," if len(types) == 1 else "") + ")\n")
+		namespace = {"t" + str(i): t for (i, t) in enumerate(types)}
+		namespace.update( delim = delim, n = len(types), types = types )
+		exec( source, namespace )
+		return namespace["parse"]
+		
 	def n_attributes( self ):
 		return len(self._attributes)
 		
@@ -166,29 +318,102 @@ class Relation:
 	def type( self, name ):
 		return self.attribute( name ).type()
 		
+	def row( self, row_data=None ):
+		""" Returns a Row of this relation that is a view of the tuple
+		`row_data`.
+		"""
+		return row_type( self.names() )( self, row_data )
+		
+	batch_size = 65536
+	
+	def batches( self, idx=None ):
+		""" Returns an iterator over the tuples of the relation in batches,
+		each given as a list of columns: one list of values for each position
+		in `idx`, or for each attribute if `idx` is None.
+		
+		Operators that work a column at a time consume their input this way.
+		The default implementation collects `batch_size` tuples at a time and
+		splits them into columns; sub-classes override it to hand out their
+		columns without assembling tuples. A SinglePassRelation must be
+		consumed either by iteration or by `batches()`, not both. The batches
+		must not be modified, and a relation without attributes has none.
+		"""
+		if self.n_attributes() == 0:
+			return
+		itr = iter(self)
+		if idx is not None and len(idx) == 1:
+			# Pick out the single column with one C-level map over the input
+			values = map( operator.itemgetter( idx[0] ), itr )
+			while True:
+				xs = list( itertools.islice( values, self.batch_size ) )
+				if not xs:
+					return
+				yield [xs]
+		while True:
+			chunk = list( itertools.islice( itr, self.batch_size ) )
+			if not chunk:
+				return
+			if idx is None:
+				yield InMemoryRelation( attributes = self._attributes, data = chunk )._columns
+			else:
+				yield [list( map( operator.itemgetter( i ), chunk ) ) for i in idx]
+			
 	def rows( self ):
 		""" Returns an Iterable yielding a Row instance for each tuple in the
 		relation.
 		"""
+		cls = row_type( self.names() )
 		for t in self:
-			yield Row( self, t )
+			yield cls( self, t )
 			
 	def __eq__( self, other ):
+		# Compare pairs of tuples as they are produced, without materializing
+		# either relation. The fill value is unequal to any tuple, so a
+		# difference in length compares unequal.
+		end = object()
 		return (self.attributes() == other.attributes() and
-			    [t for t in self] == [t for t in other])
+				all( itertools.starmap( operator.eq, itertools.zip_longest( self, other, fillvalue=end ) ) ))
 		
 # ----------------------------------------------------------------------------
 # ----------------------------------------------------------------------------
 
-class FileStreamRelation(Relation):
-	""" A SinglePassRelation backed by a file.
+class PipelineRelation(Relation):
+	""" A SinglePassRelation whose tuples are produced by the iterator
+	`self._itr`.
+	
+	`iter()` returns `self._itr` itself rather than `self`. Sub-classes build
+	`_itr` from builtin iterators such as `map` and `filter` over the input
+	iterator, so that a chain of PipelineRelations is evaluated as nested
+	C-level iterators, without a Python-level `__next__` call per stage.
 	"""
+	
+	def __next__( self ):
+		return next(self._itr)
+		
+	def __iter__( self ):
+		return self._itr
+		
+# ----------------------------------------------------------------------------
 
+class FileStreamRelation(PipelineRelation):
+	""" A SinglePassRelation backed by a file.
+	
+	The file is read in blocks of `block_size` characters, and the complete
+	lines of each block are parsed together with `Relation.parse_tuples()`.
+	"""
+	
+	block_size = 1 << 20
+	
 	def __init__( self, filename, delim=',', type_delim=None ):
 		self._file = open( filename )
 		self._delim = delim
-		self._itr = iter(self._file)
-		super().__init__( attributes = Relation.parse_attributes( next(self._itr), delim, type_delim ) )
+		try:
+			attributes = Relation.parse_attributes( self._file.readline(), delim, type_delim )
+		except BaseException:
+			self._file.close()
+			raise
+		super().__init__( attributes = attributes )
+		self._itr = itertools.chain.from_iterable( self._batches() )
 		
 	def close( self ):
 		self._file.close()
@@ -201,44 +426,167 @@ class FileStreamRelation(Relation):
 	def open_typed( filename, delim=',', type_delim=':' ):
 		return FileStreamRelation( filename, delim, type_delim )
 		
-	def __iter__( self ):
-		return self
-	
-	def __next__( self ):
-		return tuple( self._attributes[i].type()( s )
-					  for (i, s) in enumerate( next(self._itr).rstrip( '\n' ).split( self._delim ) ) )
+	def _batches( self ):
+		""" Yields the tuples of the file as one list per block.
+		"""
+		# The header is line 1
+		first_line = 2
+		for lines in line_blocks( self._file, self.block_size ):
+			yield Relation.parse_tuples( lines, self._attributes, self._delim, first_line )
+			first_line += len(lines)
+			
+	def batches( self, idx=None ):
+		""" Yields the columns of each block of the file, as parsed by
+		`Relation.parse_columns()`, without assembling tuples.
+		"""
+		first_line = 2
+		for lines in line_blocks( self._file, self.block_size ):
+			columns = Relation.parse_columns( lines, self._attributes, self._delim )
+			if columns is None:
+				ts = Relation.parse_tuples( lines, self._attributes, self._delim, first_line )
+				columns = InMemoryRelation( attributes = self._attributes, data = ts )._columns
+			first_line += len(lines)
+			yield columns if idx is None else [columns[i] for i in idx]
 
 # ----------------------------------------------------------------------------
 		
 class InMemoryRelation(Relation):
 	""" A RestartableRelation backed by data in memory.
+	
+	The data is stored by column: one list of values per attribute. Tuples
+	are assembled when the relation is iterated.
+	
+	Parameters:
+	
+	- `data`: `[tuple]` The tuples of the relation, or
+	- `columns`: `[list]` One list of values per attribute, all of the same
+		length. The lists become owned by the relation.
 	"""
 	
-	def __init__( self, attributes, data ):
+	def __init__( self, attributes, data=None, columns=None ):
 		super().__init__( attributes = attributes )
-		self._data = data
+		if columns is None:
+			data = list( data )
+			if set( map( len, data ) ) - {self.n_attributes()}:
+				raise TypeError( "Tuple length does not match attribute count" )
+			columns = [list( map( operator.itemgetter( i ), data ) ) for i in range(self.n_attributes())]
+			self._n = len(data)
+		else:
+			columns = list( columns )
+			if len(columns) != self.n_attributes():
+				raise TypeError( "Column count does not match attribute count" )
+			self._n = len(columns[0]) if columns else 0
+			if any( len(c) != self._n for c in columns ):
+				raise TypeError( "Unequal column lengths" )
+		self._columns = columns
+		
+	def __len__( self ):
+		return self._n
+		
+	def __eq__( self, other ):
+		if isinstance( other, InMemoryRelation ):
+			return (self.attributes() == other.attributes() and self._n == other._n
+					and self._columns == other._columns)
+		return super().__eq__( other )
+		
+	def column( self, name ):
+		""" Returns the list of values in column `name`. The list is the
+		storage of the relation and must not be modified.
+		"""
+		return self._columns[self.index( name )]
 		
 	def sort( self, key = None, reverse = False ):
-		if key is not None:
-			idx = tuple( self.index(n) for n in key )
-			self._data.sort( key = operator.itemgetter( *idx ), reverse = reverse )
+		""" Sorts the tuples in place by the columns named in `key`, or by
+		whole tuples if `key` is None. The sort is stable.
+		
+		A permutation of the row indices is sorted, and the columns are then
+		gathered through it. With a `key`, the permutation is sorted by one
+		key column at a time, from the last key to the first, so that each
+		pass compares single values rather than key tuples; this relies on the
+		stability of `list.sort()`.
+		"""
+		perm = list( range(self._n) )
+		if key is None:
+			# Comparisons of whole tuples mostly stop at the first column, which
+			# is cheaper than one pass per column
+			perm.sort( key = list( self ).__getitem__, reverse = reverse )
 		else:
-			self._data.sort( reverse = reverse )
+			for i in reversed([self.index(n) for n in key]):
+				perm.sort( key = self._columns[i].__getitem__, reverse = reverse )
+		self._columns = [list( map( c.__getitem__, perm ) ) for c in self._columns]
 		
 	@staticmethod
 	def copy_of( relation ):
-		cp = list( t for t in relation )
-		return InMemoryRelation( attributes = relation._attributes, data = cp )
+		""" Returns an InMemoryRelation with the attributes and tuples of
+		`relation`.
+		
+		The columns of each of the `batches()` of `relation` are appended to
+		the result, so that only one batch is held in memory at a time.
+		"""
+		if isinstance( relation, InMemoryRelation ):
+			return InMemoryRelation( attributes = relation._attributes,
+									 columns = [list( c ) for c in relation._columns] )
+		if relation.n_attributes() == 0:
+			return InMemoryRelation( attributes = relation._attributes, data = list( relation ) )
+		columns = [[] for a in relation._attributes]
+		for block in relation.batches():
+			for (c, b) in zip( columns, block ):
+				c.extend( b )
+		return InMemoryRelation( attributes = relation._attributes, columns = columns )
 		
 	@staticmethod
-	def from_file( filename, delim=',' ):
-		with FileStreamRelation.open( filename ) as r:
+	def from_file( filename, delim=',', type_delim=None ):
+		""" Loads a relation from a file.
+		
+		The file is read in blocks of `FileStreamRelation.block_size`
+		characters, and each block is parsed into columns and appended to the
+		result, so that the text of the whole file is never held in memory.
+		"""
+		r = FileStreamRelation( filename, delim, type_delim )
+		try:
 			return InMemoryRelation.copy_of( r )
+		finally:
+			r.close()
 	
 	@staticmethod
 	def from_file_typed( filename, delim=',', type_delim=':' ):
-		with FileStreamRelation.open_typed( filename ) as r:
-			return InMemoryRelation.copy_of( r )
+		return InMemoryRelation.from_file( filename, delim, type_delim )
 		
+	# Identifies files written by `write_binary()`
+	_BINARY_FORMAT = ("csvq", 1)
+	
+	def write_binary( self, out ):
+		""" Writes the attributes and the columns to the binary file handle
+		`out` with `pickle`, so that `from_binary()` can restore them without
+		parsing or formatting any values.
+		"""
+		header = [(a.name(), a.type_string()) for a in self._attributes]
+		pickle.dump( (InMemoryRelation._BINARY_FORMAT, header, self._n, self._columns),
+					 out, protocol=pickle.HIGHEST_PROTOCOL )
+		
+	@staticmethod
+	def from_binary( filename ):
+		""" Loads a relation written by `write_binary()`.
+		
+		The file is read with `pickle`, so it must come from a trusted source.
+		"""
+		with open( filename, "rb" ) as f:
+			(format, header, n, columns) = pickle.load( f )
+		if format != InMemoryRelation._BINARY_FORMAT:
+			raise TypeError( "Unsupported binary format: " + repr(format) )
+		attributes = tuple( Attribute( name, Attribute.parse_type( type ) ) for (name, type) in header )
+		r = InMemoryRelation( attributes = attributes, columns = columns )
+		r._n = n
+		return r
+		
+	def batches( self, idx=None ):
+		""" Yields the stored columns as a single batch.
+		"""
+		if self._columns:
+			yield self._columns if idx is None else [self._columns[i] for i in idx]
+			
 	def __iter__( self ):
-		return iter(self._data)
+		if self._columns:
+			return zip( *self._columns )
+		else:
+			return itertools.repeat( (), self._n )
@@ -0,0 +1,330 @@
+# LICENSE --------------------------------------------------------------------
+# Copyright 2017 Jesse A. Hostetler
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+""" Rewriting of user functions on Rows into functions on tuples.
+
+A function such as `lambda t: t.Salary * t.Age` is re-compiled from its source
+with each column reference `t.Name` or `t("Name")` replaced by the positional
+index `t[i]`, so that it can be applied to the tuples of a relation directly,
+without a Row. Functions that cannot be rewritten safely are wrapped so that
+they receive a Row, as before.
+"""
+
+import ast
+import builtins
+import copy
+import functools
+import inspect
+import itertools
+import operator
+import sys
+import types
+import weakref
+
+from csvq.relation import Row
+
+# ----------------------------------------------------------------------------
+
+def tuple_function( relation, f, arg=0 ):
+	""" Returns a function equivalent to `f`, except that it takes a tuple of
+	`relation` in place of a Row as positional argument `arg`.
+	
+	Only `arg` values 0 (for `f( row )`) and 1 (for `f( acc, row )`) are
+	supported.
+	"""
+	g = rewrite( relation, f, arg )
+	if g is not None:
+		return g
+	row = relation.row()
+	if arg == 0:
+		def on_row( t ):
+			row._row_data = t
+			return f( row )
+	elif arg == 1:
+		def on_row( acc, t ):
+			row._row_data = t
+			return f( acc, row )
+	else:
+		raise ValueError( arg )
+	return on_row
+
+def rewrite( relation, f, arg=0 ):
+	""" Returns `f` re-compiled to take a tuple of `relation` as positional
+	argument `arg`, or None if `f` cannot be rewritten.
+	
+	`f` can be rewritten if it is a lambda or function whose source is
+	available, which uses its argument `arg` only as `t.Name`, `t("Name")` or
+	`t[...]`, where "Name" is a column of `relation` that is not shadowed by
+	an attribute of Row.
+	"""
+	if type(f) is not types.FunctionType:
+		return None
+	rewritten = _rewritten.setdefault( f.__code__, {} )
+	key = (arg, tuple( relation.names() ))
+	try:
+		code = rewritten[key]
+	except KeyError:
+		code = rewritten[key] = _rewrite_code( relation, f, arg )
+	if code is None:
+		return None
+	cells = dict( zip( f.__code__.co_freevars, f.__closure__ or () ) )
+	g = types.FunctionType( code, f.__globals__, f.__name__, f.__defaults__,
+							tuple( cells[n] for n in code.co_freevars ) )
+	g.__kwdefaults__ = f.__kwdefaults__
+	g.__qualname__ = f.__qualname__
+	return g
+
+def column_fold( relation, f ):
+	""" Returns a function `g( columns, init )` that computes the fold of `f`
+	with initial value `init` over the list of columns `columns` of
+	`relation` using builtin reductions, or None if `f` does not have one of
+	the forms:
+		- `lambda acc, t: acc + t.X`
+		- `lambda acc, t: acc + t.X * t.Y`
+		- `lambda acc, t: max( acc, t.X )` or `min( acc, t.X )`
+	
+	`g` performs the same operations, in the same order, as folding `f` over
+	the tuples, so the result is identical.
+	"""
+	if type(f) is not types.FunctionType:
+		return None
+	node = _find_node( f )
+	if not isinstance( node, ast.Lambda ):
+		return None
+	params = _parameters( node )
+	if len(params) != 2:
+		return None
+	(acc, t) = (params[0].arg, params[1].arg)
+	
+	def is_name( e, name ):
+		return isinstance( e, ast.Name ) and e.id == name
+		
+	def column( e ):
+		""" The position of the column that `e` reads from `t`, or None """
+		if isinstance( e, ast.Attribute ) and is_name( e.value, t ):
+			name = e.attr
+		elif (isinstance( e, ast.Call ) and is_name( e.func, t ) and not e.keywords
+			  and len(e.args) == 1 and _string( e.args[0] ) is not None):
+			name = _string( e.args[0] )
+		else:
+			return None
+		if name in relation._index and not hasattr( Row, name ):
+			return relation._index[name]
+		return None
+		
+	def is_acc( e ):
+		return is_name( e, acc )
+		
+	body = node.body
+	if isinstance( body, ast.BinOp ) and isinstance( body.op, ast.Add ) and is_acc( body.left ):
+		e = body.right
+		i = column( e )
+		if i is not None:
+			return lambda columns, init: functools.reduce( operator.add, columns[i], init )
+		if isinstance( e, ast.BinOp ) and isinstance( e.op, ast.Mult ):
+			(i, j) = (column( e.left ), column( e.right ))
+			if i is not None and j is not None:
+				return lambda columns, init: functools.reduce(
+					operator.add, map( operator.mul, columns[i], columns[j] ), init )
+	elif (isinstance( body, ast.Call ) and isinstance( body.func, ast.Name )
+		  and body.func.id in ("max", "min") and not body.keywords
+		  and len(body.args) == 2 and is_acc( body.args[0] )):
+		# The name must refer to the builtin, not to a variable
+		g = getattr( builtins, body.func.id )
+		if body.func.id in f.__code__.co_freevars or f.__globals__.get( body.func.id, g ) is not g:
+			return None
+		i = column( body.args[1] )
+		if i is not None:
+			return lambda columns, init: g( itertools.chain( (init,), columns[i] ) )
+	return None
+
+# ----------------------------------------------------------------------------
+
+# {code: {(arg, names): code or None}}
+_rewritten = weakref.WeakKeyDictionary()
+
+def _rewrite_code( relation, f, arg ):
+	""" Returns the code object of `f` rewritten for `rewrite()`, or None.
+	"""
+	node = _find_node( f )
+	if node is None:
+		return None
+	params = _parameters( node )
+	if arg >= len(params):
+		return None
+	node = copy.deepcopy( node )
+	rewriter = _ColumnRewriter( params[arg].arg, relation._index )
+	if isinstance( node, ast.Lambda ):
+		node.body = rewriter.visit( node.body )
+	else:
+		node.body = [rewriter.visit( s ) for s in node.body]
+	if not rewriter.ok:
+		return None
+	try:
+		return _compile_in_scope( f, node )
+	except (SyntaxError, TypeError, ValueError):
+		return None
+		
+def _parameters( node ):
+	""" The positional parameters of the lambda or function `node` """
+	# Positional-only parameters are new in Python 3.8
+	return getattr( node.args, "posonlyargs", [] ) + node.args.args
+	
+def _string( node ):
+	""" The value of `node` if it is a string literal, else None """
+	if isinstance( node, ast.Constant ) and isinstance( node.value, str ):
+		return node.value
+	# Before Python 3.8, string literals are parsed as ast.Str
+	if sys.version_info < (3, 8) and isinstance( node, ast.Str ):
+		return node.s
+	return None
+
+# {filename: (source, tree)}
+_trees = {}
+# {code: node or None}
+_nodes = weakref.WeakKeyDictionary()
+
+def _find_node( f ):
+	""" Returns the `ast.Lambda` or `ast.FunctionDef` node that `f` was compiled
+	from, or None if it cannot be identified unambiguously.
+	
+	The candidates are the nodes on the line where `f` is defined. A candidate
+	is accepted only if compiling it reproduces the code of `f`, which also
+	checks that `_compile_in_scope()` reproduces the scope of `f`. The result
+	is cached by the code object of `f`, which is shared by every function
+	created from the same definition.
+	"""
+	code = f.__code__
+	try:
+		return _nodes[code]
+	except KeyError:
+		pass
+	try:
+		node = _search_node( f )
+	except (OSError, TypeError, SyntaxError, ValueError):
+		node = None
+	_nodes[code] = node
+	return node
+	
+def _search_node( f ):
+	code = f.__code__
+	(lines, _) = inspect.findsource( f )
+	source = "".join( lines )
+	cached = _trees.get( code.co_filename )
+	if cached is None or cached[0] != source:
+		cached = (source, ast.parse( source ))
+		_trees[code.co_filename] = cached
+	tree = cached[1]
+	
+	def first_line( node ):
+		if isinstance( node, ast.FunctionDef ):
+			return min( [node.lineno] + [d.lineno for d in node.decorator_list] )
+		return node.lineno
+		
+	matches = []
+	for node in ast.walk( tree ):
+		if (isinstance( node, (ast.Lambda, ast.FunctionDef) )
+			and first_line( node ) == code.co_firstlineno):
+			c = _compile_in_scope( f, node )
+			if (c.co_code == code.co_code and c.co_consts == code.co_consts
+				and c.co_names == code.co_names and c.co_varnames == code.co_varnames
+				and c.co_freevars == code.co_freevars):
+				matches.append( node )
+	if len(matches) != 1:
+		return None
+	return matches[0]
+
+def _compile_in_scope( f, node ):
+	""" Compiles the lambda or function `node` inside a function whose
+	parameters are the free variables of `f`, and returns its code object.
+	"""
+	code = f.__code__
+	outer = ast.parse( "def _outer(" + ", ".join( code.co_freevars ) + "): pass" )
+	if isinstance( node, ast.Lambda ):
+		outer.body[0].body = [ast.Return( node )]
+	else:
+		node = copy.copy( node )
+		node.decorator_list = []
+		outer.body[0].body = [node, ast.Return( ast.Name( node.name, ast.Load() ) )]
+	ast.fix_missing_locations( outer )
+	module = compile( outer, code.co_filename, "exec" )
+	for c in module.co_consts:
+		if isinstance( c, types.CodeType ) and c.co_name == "_outer":
+			for inner in c.co_consts:
+				if isinstance( inner, types.CodeType ) and inner.co_name == code.co_name:
+					return inner
+	raise ValueError( "compiled code not found" )
+
+class _ColumnRewriter(ast.NodeTransformer):
+	""" Replaces the column references of the Row parameter `name` with
+	positional indices. Sets `ok` to False if `name` is used in any other
+	way, or is re-bound in a nested scope.
+	"""
+	
+	def __init__( self, name, index ):
+		self._name = name
+		self._index = index
+		self.ok = True
+		
+	def _is_row( self, node ):
+		return isinstance( node, ast.Name ) and node.id == self._name
+		
+	def _column( self, name ):
+		if name in self._index and not hasattr( Row, name ):
+			index = ast.Constant( self._index[name] )
+			# Before Python 3.9, a subscript must be wrapped in ast.Index
+			if sys.version_info < (3, 9):
+				index = ast.Index( index )
+			return ast.Subscript( ast.Name( self._name, ast.Load() ), index, ast.Load() )
+		self.ok = False
+		return None
+		
+	def visit_Attribute( self, node ):
+		if self._is_row( node.value ) and isinstance( node.ctx, ast.Load ):
+			return ast.copy_location( self._column( node.attr ) or node, node )
+		return self.generic_visit( node )
+		
+	def visit_Call( self, node ):
+		if (self._is_row( node.func ) and not node.keywords and len(node.args) == 1
+			and _string( node.args[0] ) is not None):
+			return ast.copy_location( self._column( _string( node.args[0] ) ) or node, node )
+		return self.generic_visit( node )
+		
+	def visit_Subscript( self, node ):
+		if self._is_row( node.value ) and isinstance( node.ctx, ast.Load ):
+			# Row.__getitem__ indexes the tuple itself
+			node.slice = self.visit( node.slice )
+			return node
+		return self.generic_visit( node )
+		
+	def visit_Name( self, node ):
+		if node.id == self._name:
+			self.ok = False
+		return node
+		
+	def visit_arg( self, node ):
+		if node.arg == self._name:
+			self.ok = False
+		return node
@@ -23,41 +23,60 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 # ----------------------------------------------------------------------------
 
-import collections
 import itertools
+import operator
 
-from csvq.relation import Attribute, Relation, Row
+from csvq.relation import Attribute, InMemoryRelation, PipelineRelation, Relation, Row, tuple_getter
 
 # ----------------------------------------------------------------------------
 
-class HCat(Relation):
+def zip_equal( itrs ):
+	""" Like `zip( *itrs )`, but raises `RuntimeError` after the last tuple if
+	the iterators do not all have the same length.
+	
+	Each iterator is chained with a marker that records its position when it
+	is exhausted, so the tuples are produced by `zip` itself and the lengths
+	are checked only once, at the end.
+	"""
+	ended = []
+	lanes = [itertools.chain( itr, _end_marker( ended, k ) ) for (k, itr) in enumerate(itrs)]
+	return itertools.chain( zip( *lanes ), _check_ended( ended, lanes ) )
+	
+# Unequal to any value produced by an input
+_END = object()
+
+def _end_marker( ended, k ):
+	ended.append( k )
+	yield from ()
+	
+def _check_ended( ended, lanes ):
+	# `zip` stops at the first lane that is exhausted. If that is not lane 0,
+	# the earlier lanes were longer; otherwise, any later lane that is not yet
+	# exhausted is longer.
+	if ended[:1] != [0] or any( next(lane, _END) is not _END for lane in lanes[1:] ):
+		raise RuntimeError( "Unequal tuple counts" )
+	yield from ()
+
+# ----------------------------------------------------------------------------
+
+class HCat(PipelineRelation):
 	def __init__( self, r1, r2, *rest ):
 		relations = [r1, r2, *rest]
-		name_type = collections.OrderedDict()
-		for r in relations:
-			for n in r.names():
-				if n in name_type:
-					raise TypeError( "Duplicate column name '" + n + "'" )
-				else:
-					name_type[n] = r.type( n )
-		
-		attrs = tuple( Attribute(name, type) for (name, type) in name_type.items() )
-		super().__init__( attributes = attrs )
-		self._itrs = tuple( iter(r) for r in  relations )
-		
-	def __next__( self ):
-		ts = tuple( next(itr, None) for itr in self._itrs )
-		stopped = tuple( t is None for t in ts )
-		if any(stopped):
-			if not all(stopped):
-				raise RuntimeError( "Unequal tuple counts" )
-			else:
-				raise StopIteration()
-		return tuple( e for t in ts for e in t )
+		attrs = [a for r in relations for a in r.attributes()]
+		index = {}
+		for (i, a) in enumerate(attrs):
+			if index.setdefault( a.name(), i ) != i:
+				raise TypeError( "Duplicate column name '" + a.name() + "'" )
+		super().__init__( attributes = attrs, index = index )
+		# Rows are joined by tuple concatenation, which is faster than
+		# flattening with chain.from_iterable(); the lengths are checked once,
+		# at the end (see `zip_equal()`)
+		ts = zip_equal( [iter(r) for r in relations] )
+		if len(relations) == 2:
+			self._itr = itertools.starmap( operator.add, ts )
+		else:
+			self._itr = map( sum, ts, itertools.repeat( () ) )
 		
-	def __iter__( self ):
-		return self
-
 # ----------------------------------------------------------------------------
 
 class VCat(Relation):
@@ -67,9 +86,14 @@ class VCat(Relation):
 		for r in relations[1:]:
 			if attr_set != set( r.attributes() ):
 				raise TypeError( "Incompatible attribute sets" )
-		super().__init__( attributes = r1.attributes() )
+		super().__init__( attributes = r1.attributes(), index = r1._index )
+		self._relations = relations
 		self._itr = itertools.chain.from_iterable( iter(r) for r in relations )
 		
+	def batches( self, idx=None ):
+		for r in self._relations:
+			yield from r.batches( idx )
+		
 	def __next__( self ):
 		return next( self._itr )
 		
@@ -78,35 +102,33 @@ class VCat(Relation):
 		
 # ----------------------------------------------------------------------------
 
-class Assign(Relation):
+class Assign(PipelineRelation):
 	def __init__( self, relation, changes ):
 		for attr in changes.attributes():
 			if relation.attribute( attr.name() ) != attr:
 				raise TypeError( "Incompatible attribute sets" )
 		super().__init__( attributes = relation._attributes, index = relation._index )
-		self._idx = tuple( (relation.index(name), changes.index(name)) for name in changes.names() )
-		self._ritr = iter(relation)
-		self._citr = iter(changes)
-		
-	def __next__( self ):
-		tr = next(self._ritr, None)
-		tc = next(self._citr, None)
-		if tr is None or tc is None:
-			if tr is None and tc is None:
-				raise StopIteration()
-			else:
-				raise RuntimeError( "Unequal tuple counts" )
-		u = list(tr)
-		for (r, c) in self._idx:
-			u[r] = tc[c]
-		return tuple(u)
-		
-	def __iter__( self ):
-		return self
+		# Output position i picks element perm[i] of the concatenation of the
+		# relation tuple and the changes tuple
+		n = relation.n_attributes()
+		perm = list( range(n) )
+		for name in changes.names():
+			perm[relation.index(name)] = n + changes.index(name)
+		pick = tuple_getter( perm )
+		ts = zip_equal( [iter(relation), iter(changes)] )
+		self._itr = map( pick, itertools.starmap( operator.add, ts ) )
 
 # ----------------------------------------------------------------------------
 
-class AlterType(Relation):
+class AlterType(PipelineRelation):
+	""" Converts the values of some columns to new types.
+	
+	If the input is an InMemoryRelation, each altered column is converted by
+	mapping the new type over the stored column, and the output tuples are
+	zipped from the (lazily) converted columns. Otherwise the tuples are
+	converted one at a time.
+	"""
+	
 	def __init__( self, relation, td ):
 		idx = []
 		attrs = list( relation.attributes() )
@@ -114,15 +136,27 @@ class AlterType(Relation):
 			if a.name() in td:
 				attrs[i] = Attribute( a.name(), td[a.name()] )
 				idx.append( i )
-		super().__init__( attributes = attrs )
+		# The names are unchanged, so the index of the input applies
+		super().__init__( attributes = attrs, index = relation._index )
+		self._in_relation = relation
 		self._idx = tuple( idx )
-		self._itr = iter(relation)
+		if isinstance( relation, InMemoryRelation ) and relation.n_attributes() > 0:
+			types = tuple( a.type() for a in self._attributes )
+			self._itr = zip( *[map( types[i], c ) if i in self._idx else iter(c)
+							   for (i, c) in enumerate(relation._columns)] )
+		else:
+			self._itr = map( self._convert_row, iter(relation) )
 		
-	def __next__( self ):
-		t = list( next(self._itr) )
+	def batches( self, idx=None ):
+		if idx is None:
+			idx = range(self.n_attributes())
+		types = tuple( a.type() for a in self._attributes )
+		for columns in self._in_relation.batches( idx ):
+			yield [list( map( types[i], c ) ) if i in self._idx else c
+				   for (i, c) in zip( idx, columns )]
+			
+	def _convert_row( self, t ):
+		t = list( t )
 		for i in self._idx:
 			t[i] = self._attributes[i].type()( t[i] )
 		return tuple( t )
-		
-	def __iter__( self ):
-		return self
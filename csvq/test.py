@@ -24,9 +24,13 @@
 # ----------------------------------------------------------------------------
 
 import os
+import pickle
 import statistics
 import unittest
 
+import csvq.aggregate as csvq_aggregate
+import csvq.relation
+import csvq.rewrite
 from csvq import *
 
 class TestApi(unittest.TestCase):
@@ -70,9 +74,23 @@ class TestApi(unittest.TestCase):
 		self.assertEqual( attrs[4].type(), float )
 		self.assertEqual( len(tuples( r )), 6 )
 		
+	def test_load_blocks( self ):
+		block_size = csvq.relation.FileStreamRelation.block_size
+		try:
+			csvq.relation.FileStreamRelation.block_size = 7
+			r = load_typed( "examples/employees-typed.csv" )
+		finally:
+			csvq.relation.FileStreamRelation.block_size = block_size
+		self.assertEqual( self.employees, r )
+		
+	def test_load_many( self ):
+		(e, p) = load_many_typed( ["examples/employees-typed.csv", "examples/parents-typed.csv"] )
+		self.assertEqual( self.employees, e )
+		self.assertEqual( load_typed( "examples/parents-typed.csv" ), p )
+		(u,) = load_many( ["examples/employees-untyped.csv"] )
+		self.assertEqual( load( "examples/employees-untyped.csv" ), u )
+		
 	def test_load_typed_from_untyped( self ):
-		# Note: This test causes a ResourceWarning for 'unclosed file'. I
-		# believe this is spurious.
 		with self.assertRaises( TypeError ):
 			r = load_typed( "examples/employees-untyped.csv" )
 		
@@ -88,6 +106,36 @@ class TestApi(unittest.TestCase):
 			f = evaluate( s )
 			self.assertEqual( len(tuples(f)), 0 )
 			
+	def test_stream_blocks( self ):
+		with stream_typed( "examples/employees-typed.csv" ) as s:
+			s.block_size = 7
+			self.assertEqual( tuples( self.employees ), tuples( s ) )
+		
+	def test_load_ragged( self ):
+		try:
+			tmp_file = "__tmp_ragged.csv"
+			for (text, line) in [("a,b\n1,2\n\n", 3), ("a,b\n1,2\n3,4\n5\n6,7\n", 4), ("a||b\n1||2\n3\n", 3)]:
+				with open( tmp_file, "w" ) as out:
+					out.write( text )
+				delim = "||" if "||" in text else ","
+				for block_size in [csvq.relation.FileStreamRelation.block_size, 4]:
+					with self.subTest( text = text, block_size = block_size ):
+						saved = csvq.relation.FileStreamRelation.block_size
+						try:
+							csvq.relation.FileStreamRelation.block_size = block_size
+							with self.assertRaisesRegex( TypeError, "^Line {}:".format( line ) ):
+								load( tmp_file, delim )
+							with self.assertRaisesRegex( TypeError, "^Line {}:".format( line ) ):
+								with stream( tmp_file, delim ) as s:
+									tuples( s )
+						finally:
+							csvq.relation.FileStreamRelation.block_size = saved
+			with open( tmp_file, "w" ) as out:
+				out.write( "a\n1\n\n" )
+			self.assertEqual( tuples( load( tmp_file ) ), [("1",), ("",)] )
+		finally:
+			os.remove( tmp_file )
+		
 	def test_stream_typed_from_untyped( self ):
 		with self.assertRaises( TypeError ):
 			with stream_typed( "examples/employees-untyped.csv" ) as s:
@@ -104,6 +152,33 @@ class TestApi(unittest.TestCase):
 		finally:
 			os.remove( tmp_file )
 	
+	def test_write_delim( self ):
+		try:
+			tmp_file = "__tmp_employees.csv"
+			with open( tmp_file, "w" ) as out:
+				write_typed( self.employees, out, delim=";" )
+			cp = load_typed( tmp_file, delim=";" )
+			self.assertEqual( self.employees, cp )
+			with open( tmp_file, "w" ) as out:
+				write_typed( self.employees, out, delim="||" )
+			cp = load_typed( tmp_file, delim="||" )
+			self.assertEqual( self.employees, cp )
+			with stream_typed( tmp_file, delim="||" ) as s:
+				self.assertEqual( tuples( self.employees ), tuples( s ) )
+		finally:
+			os.remove( tmp_file )
+	
+	def test_write_binary( self ):
+		try:
+			tmp_file = "__tmp_employees.bin"
+			with open( tmp_file, "wb" ) as out:
+				write_binary( self.employees | select( lambda t: True ), out )
+			cp = load_binary( tmp_file )
+			self.assertEqual( self.employees, cp )
+			self.assertEqual( tuples( self.employees ), tuples( cp ) )
+		finally:
+			os.remove( tmp_file )
+		
 	def test_write_typed( self ):
 		try:
 			tmp_file = "__tmp_employees.csv"
@@ -141,6 +216,14 @@ class TestApi(unittest.TestCase):
 		self.assertEqual( ts[0], ("Bart", 10, "M", "Policeman", 20000.0) )
 		self.assertEqual( ts[1], ("Martin", 10, "M", "Systems analyst", 40000.0) )
 		
+	def test_select_columns( self ):
+		expect = tuples( self.employees | select( lambda t: t.Age == 10 ) )
+		r = evaluate( self.employees | select( ("Age", lambda age: age == 10) ) )
+		self.assert_equal_attributes( self.employees, r )
+		self.assertEqual( expect, tuples( r ) )
+		r = evaluate( self.employees | select( (["Age", "Sex"], lambda age, sex: age == 10 and sex == "M") ) )
+		self.assertEqual( expect, tuples( r ) )
+		
 	def test_select_empty( self ):
 		r = evaluate( self.employees | select( lambda t: False ) )
 		self.assert_equal_attributes( self.employees, r )
@@ -156,11 +239,6 @@ class TestApi(unittest.TestCase):
 		self.assertEqual( t, r.attribute( "EmployeeName" ).type() )
 		
 	def test_natural_join( self ):
-		# FIXME: This test case generates:
-		# 	PendingDeprecationWarning: generator '__iter__' raise StopIteration
-		# Presumably this is caused by the implementation of
-		# algebra.HashNaturalJoin because it does no occur in previous tests.
-		# I don't know how to fix it right now.
 		parents = load_typed( "examples/parents-typed.csv" )
 		r = evaluate( self.employees | rename( {"Name": "ChildName"} ) | natural_join( parents ) )
 		ts = tuples( r )
@@ -195,6 +273,16 @@ class TestApi(unittest.TestCase):
 			with self.subTest( i = ti ):
 				self.assertEqual( ts[ti][i] + 10000.0, rs[ti][i] )
 				
+	def test_update_many( self ):
+		r = evaluate( self.employees | update( {"Salary": lambda t: t.Salary + 1.0, "Name": lambda t: t.Name.upper()} ) )
+		ts = tuples(self.employees)
+		rs = tuples(r)
+		self.assert_equal_attributes( self.employees, r )
+		for ti in range(0, len(ts)):
+			with self.subTest( i = ti ):
+				(name, age, sex, title, salary) = ts[ti]
+				self.assertEqual( (name.upper(), age, sex, title, salary + 1.0), rs[ti] )
+				
 	def test_fold( self ):
 		r = evaluate( self.employees | fold( {Attribute("LifetimeEarnings", float) 
 												: (lambda acc, t: acc + t.Salary * t.Age, 0)} ) )
@@ -206,6 +294,46 @@ class TestApi(unittest.TestCase):
 		self.assertEqual( len(tuples(r)), 1 )
 		self.assertEqual( check, scalar(r) )
 		
+	def test_fold_columns( self ):
+		fd = {Attribute("TotalAge", int): (lambda acc, t: acc + t.Age, 0),
+			  Attribute("MaxSalary", float): (lambda acc, t: max( acc, t("Salary") ), 0.0),
+			  Attribute("MinAge", int): (lambda acc, t: min( acc, t.Age ), 100),
+			  Attribute("Names", str): (lambda acc, t: acc + t.Name[0], "")}
+		self.assertIsNotNone( csvq.rewrite.column_fold( self.employees, fd[Attribute("TotalAge", int)][0] ) )
+		self.assertIsNone( csvq.rewrite.column_fold( self.employees, fd[Attribute("Names", str)][0] ) )
+		r = evaluate( self.employees | fold( fd ) )
+		with stream_typed( "examples/employees-typed.csv" ) as s:
+			expect = tuples( s | fold( fd ) )
+		self.assertEqual( tuples( r ), expect )
+		ts = tuples( self.employees )
+		self.assertEqual( expect, [(sum( t[1] for t in ts ), max( t[4] for t in ts ),
+								   min( t[1] for t in ts ), "".join( t[0][0] for t in ts ))] )
+		
+	def test_rewrite( self ):
+		increment = 1.0
+		f = csvq.rewrite.rewrite( self.employees, lambda t: (t.Name, t("Age"), t[2], t.Salary + increment) )
+		self.assertIsNotNone( f )
+		increment = 2.0
+		for t in tuples( self.employees ):
+			with self.subTest( t = t ):
+				self.assertEqual( f( t ), (t[0], t[1], t[2], t[4] + increment) )
+		self.assertIsNone( csvq.rewrite.rewrite( self.employees, lambda t: t.Nonexistent ) )
+		self.assertIsNone( csvq.rewrite.rewrite( self.employees, lambda t: len(tuple(t)) ) )
+		self.assertIsNone( csvq.rewrite.rewrite( self.employees, lambda t: [t.Age for t in [t]] ) )
+		# The rewritten code is cached by definition; each function keeps its own closure
+		fs = [csvq.rewrite.rewrite( self.employees, (lambda a: lambda t: t.Age + a)( a ) ) for a in (1, 2)]
+		self.assertEqual( [f( vector( self.employees ) ) for f in fs], [9, 10] )
+		r = evaluate( self.employees | select( lambda t: len(tuple(t)) == 5 and t.Age == 10 ) )
+		self.assertEqual( tuples( r ), tuples( self.employees | select( lambda t: t.Age == 10 ) ) )
+		
+	def test_rows( self ):
+		r = evaluate( self.employees | rename( {"Name": "_Name", "Age": "rebind"} ) )
+		for (t, row) in zip( tuples( r ), r.rows() ):
+			with self.subTest( t = t ):
+				self.assertEqual( (row._Name, row("rebind"), row.rebind, row.Sex), t[0:2] + t[1:3] )
+				self.assertEqual( tuple(row), t )
+		self.assertEqual( len(tuples( r | select( lambda t: t.rebind == 10 ) )), 2 )
+				
 	# ------------------------------------------------------------------------
 		
 	def test_aggregate( self ):
@@ -224,8 +352,84 @@ class TestApi(unittest.TestCase):
 		self.assertEqual( rv[4], sum(data) )
 		self.assertEqual( rv[5], statistics.variance(data) )
 		
-	# ------------------------------------------------------------------------
+	def test_aggregate_empty( self ):
+		r = evaluate( self.employees | aggregate() )
+		self.assertEqual( r.attributes(), () )
+		self.assertEqual( tuples( r ), [()] )
+		
+	def test_aggregate_chunked( self ):
+		ops = [Count, Max, Mean, Min, Sum, Variance]
+		whole = vector( self.employees | aggregate( *[("Salary", op) for op in ops] ) )
+		chunk_size = csvq_aggregate.Aggregate.chunk_size
+		try:
+			csvq_aggregate.Aggregate.chunk_size = 4
+			chunked = vector( self.employees | aggregate( *[("Salary", op) for op in ops] ) )
+		finally:
+			csvq_aggregate.Aggregate.chunk_size = chunk_size
+		for i in range(0, len(ops)):
+			with self.subTest( i = i ):
+				self.assertAlmostEqual( whole[i], chunked[i] )
+		
+	def test_aggregate_vcat( self ):
+		ops = [Count, Max, Mean, Min, Sum, Variance]
+		data = [t[0] for t in self.employees | project( "Salary" )] * 2
+		r = self.employees | vcat( self.employees ) | aggregate( *[("Salary", op) for op in ops] )
+		rv = vector( r )
+		self.assertEqual( rv[0], len(data) )
+		self.assertEqual( rv[1], max(data) )
+		self.assertAlmostEqual( rv[2], statistics.mean(data) )
+		self.assertEqual( rv[3], min(data) )
+		self.assertEqual( rv[4], sum(data) )
+		self.assertAlmostEqual( rv[5], statistics.variance(data) )
+		a = self.employees | aggregate( *[("Salary", op) for op in ops] )
+		b = self.employees | aggregate( *[("Salary", op) for op in ops] )
+		states = [x.combine( y ) for (x, y) in zip( a.states(), b.states() )]
+		s = csvq_aggregate.Aggregate.from_states( a.attributes(), states )
+		self.assertEqual( a.attributes(), s.attributes() )
+		self.assertEqual( rv, vector( s ) )
+		r1 = evaluate( self.employees | project( "Age", "Salary" ) )
+		r2 = evaluate( self.employees | project( "Salary", "Age" ) )
+		self.assertEqual( vector( r1 | vcat( r2 ) | aggregate( ("Age", Sum) ) ),
+						  vector( evaluate( r1 | vcat( r2 ) ) | aggregate( ("Age", Sum) ) ) )
+		
+	def test_aggregate_combine( self ):
+		data = [t[0] for t in self.employees | project( "Salary" )]
+		for op in [Mean, Variance]:
+			with self.subTest( op = op.__name__ ):
+				parts = op.from_values( data[:2] ).combine( op.from_values( data[2:] ) )
+				self.assertAlmostEqual( op.from_values( data ).value(), parts.value() )
+				acc = op()
+				for x in data:
+					acc( x )
+				self.assertAlmostEqual( op.from_values( data ).value(), acc.value() )
 		
+	def test_aggregate_inf( self ):
+		inf = float('inf')
+		for (data, expect) in [([inf, -inf], "nan"), ([1e308, 1e308], "inf"), ([1.0, inf], "inf")]:
+			with self.subTest( data = data ):
+				r = csvq.relation.InMemoryRelation( [Attribute( "x", float )], [(x,) for x in data] )
+				self.assertEqual( str( scalar( r | aggregate( ("x", Sum) ) ) ), expect )
+		
+	def test_aggregate_nan( self ):
+		nan = float('nan')
+		for data in [[1.0, 2.0, nan, 5.0], [nan, 1.0, 5.0, 2.0], [3.0, nan, nan, 1.0], [nan, nan]]:
+			r = csvq.relation.InMemoryRelation( [Attribute( "x", float )], [(x,) for x in data] )
+			# The result of folding with the comparison, as Max and Min did per value
+			(hi, lo) = (data[0], data[0])
+			for x in data:
+				(hi, lo) = (x if x > hi else hi, x if x < lo else lo)
+			for chunk_size in range(1, len(data) + 1):
+				with self.subTest( data = data, chunk_size = chunk_size ):
+					saved = csvq_aggregate.Aggregate.chunk_size
+					try:
+						csvq_aggregate.Aggregate.chunk_size = chunk_size
+						rv = vector( r | aggregate( ("x", Max), ("x", Min) ) )
+					finally:
+						csvq_aggregate.Aggregate.chunk_size = saved
+					self.assertEqual( [str( v ) for v in rv], [str( hi ), str( lo )] )
+		
+	# ------------------------------------------------------------------------
+	
 	def test_hcat( self ):
 		name = evaluate( self.employees | project( "Name" ) )
 		age = evaluate( self.employees | project( "Age" ) )
@@ -242,6 +446,11 @@ class TestApi(unittest.TestCase):
 				self.assertEqual( ts[i][iname], rs[i][0] )
 				self.assertEqual( ts[i][iage], rs[i][1] )
 				
+	def test_hcat_many( self ):
+		parts = [evaluate( self.employees | project( n ) ) for n in self.employees.names()]
+		r = evaluate( parts[0] | hcat( *parts[1:] ) )
+		self.assertEqual( self.employees, r )
+		
 	def test_hcat_duplicate( self ):
 		with self.assertRaises( TypeError ):
 			r = evaluate( self.employees | hcat( self.employees ) )
@@ -250,6 +459,8 @@ class TestApi(unittest.TestCase):
 		parents = load_typed( "examples/parents-typed.csv" )
 		with self.assertRaises( RuntimeError ):
 			r = evaluate( self.employees | hcat( parents ) )
+		with self.assertRaises( RuntimeError ):
+			r = evaluate( parents | hcat( self.employees ) )
 				
 	def test_vcat( self ):
 		r = evaluate( self.employees | vcat( self.employees ) )
@@ -328,6 +539,55 @@ class TestApi(unittest.TestCase):
 	def test_vector( self ):
 		self.assertEqual( vector( self.employees ), ("Lisa", 8, "F", "Homemaker", 0.0) )
 		
+	def test_batches( self ):
+		expect = evaluate( self.employees | project( "Salary", "Age" ) | alter_type( {"Age": float} ) )
+		with stream_typed( "examples/employees-typed.csv" ) as s:
+			r = s | rename( {"Name": "N"} ) | project( "Salary", "Age" ) | alter_type( {"Age": float} )
+			columns = [sum( cs, [] ) for cs in zip( *r.batches() )]
+		self.assertEqual( columns, [expect.column( "Salary" ), expect.column( "Age" )] )
+		with stream_typed( "examples/employees-typed.csv" ) as s:
+			r = s | select( lambda t: True ) | alter_type( {"Age": float} )
+			columns = [sum( cs, [] ) for cs in zip( *r.batches( [r.index( "Salary" ), r.index( "Age" )] ) )]
+		self.assertEqual( columns, [expect.column( "Salary" ), expect.column( "Age" )] )
+		self.assertEqual( [[len(c) for c in b] for b in (self.employees | vcat( self.employees )).batches()],
+						  [[len(self.employees)] * self.employees.n_attributes()] * 2 )
+		self.assertEqual( list( (self.employees | project()).batches() ), [] )
+		
+	def test_copy_batches( self ):
+		batch_size = csvq.relation.Relation.batch_size
+		try:
+			csvq.relation.Relation.batch_size = 4
+			with stream_typed( "examples/employees-typed.csv" ) as s:
+				r = evaluate( s | select( lambda t: True ) )
+		finally:
+			csvq.relation.Relation.batch_size = batch_size
+		self.assertEqual( self.employees, r )
+		
+	def test_equal( self ):
+		self.assertEqual( self.employees, load_typed( "examples/employees-typed.csv" ) )
+		with stream_typed( "examples/employees-typed.csv" ) as s:
+			self.assertEqual( self.employees, s )
+		young = lambda t: t.Age < 10
+		self.assertNotEqual( self.employees, evaluate( self.employees | select( young ) ) )
+		self.assertNotEqual( evaluate( self.employees | select( young ) ), self.employees )
+		self.assertNotEqual( self.employees | select( young ), self.employees )
+		
+	def test_attribute_interned( self ):
+		self.assertIs( Attribute( "Age", int ), self.employees.attribute( "Age" ) )
+		self.assertIsNot( Attribute( "Age", float ), self.employees.attribute( "Age" ) )
+		r = self.employees | alter_type( {"Age": float} )
+		self.assertIs( r.attribute( "Age" ), Attribute( "Age", float ) )
+		self.assertEqual( r.index( "Salary" ), self.employees.index( "Salary" ) )
+		for protocol in range(0, pickle.HIGHEST_PROTOCOL + 1):
+			with self.subTest( protocol = protocol ):
+				a = pickle.loads( pickle.dumps( self.employees.attribute( "Age" ), protocol ) )
+				self.assertIs( a, self.employees.attribute( "Age" ) )
+		
+	def test_column( self ):
+		iage = self.employees.index( "Age" )
+		self.assertEqual( self.employees.column( "Age" ), [t[iage] for t in tuples( self.employees )] )
+		self.assertEqual( len(self.employees), len(tuples( self.employees )) )
+		
 	# ------------------------------------------------------------------------
 	
 	def test_sort_key( self ):